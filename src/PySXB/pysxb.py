@@ -7,6 +7,9 @@ David Couples
 """
 from __future__ import annotations
 
+import mmap
+import struct
+
 import serial
 
 AT = bytes((0x55, 0xAA))
@@ -15,9 +18,32 @@ WRITE = 0x02
 READ = 0x03
 TIDE = 0x04
 EXEC = 0x05
+# Transfers are latency bound: every write() pays the driver and USB/UART
+# turnaround cost regardless of size, so throughput is roughly
+# block_size / per-call latency.  Larger blocks mean fewer calls per transfer.
 BLK_SIZE = 0x3E
 OK = 0xCC
 
+# command headers: code, 24-bit address (low word, bank byte), 16-bit length
+CMD = struct.Struct('<B')
+CMD_ADDR = struct.Struct('<BHB')
+CMD_LEN = struct.Struct('<BH')
+CMD_ADDR_LEN = struct.Struct('<BHBH')
+
+# register block loaded into monitor RAM by sxb_execute:
+# A, X, Y, PC, D, S (16-bit), P, E, PBR, DBR (8-bit)
+PROCESSOR_STATE = struct.Struct('<6H4B')
+
+# offsets from the shadow vector base:
+# coprocessor, abort, NMI, break, reset, IRQ
+VECTORS_NATIVE = (0x00, 0x04, 0x06, 0x02, 0x08, 0x0A)
+VECTORS_EMULATION = (0x10, 0x14, 0x16, 0x1A, 0x18, 0x1A)
+
+# little endian fields read in place; 24-bit addresses are read as 32 bits and masked
+# when the buffer has a byte to spare
+U16 = struct.Struct('<H')
+U32 = struct.Struct('<I')
+
 
 class PySXB(serial.Serial):
     """PySXB
@@ -29,13 +55,24 @@ class PySXB(serial.Serial):
         speed (int): speed of communication (baud rate) default 9600
         emulation_mode (bool): Sets the if emulation is turned on or off
             defaults to True.  W65C02SXB should be true
+        block_size (int): number of bytes sent per write when loading memory,
+            defaults to BLK_SIZE.  Raise it if the board firmware keeps up
         **kwargs: additional keyword args to pass for serial package
+
+    Raises:
+        ValueError: if block_size is not a positive number of bytes
     """
 
-    def __init__(self, port, baud=9600, emulation_mode=True, **kwargs):
+    def __init__(self, port, baud=9600, emulation_mode=True, block_size=BLK_SIZE, **kwargs):
+
+        if block_size < 1:
+            raise ValueError(f"block_size must be positive, got {block_size}")
 
         super().__init__(port=port, baudrate=baud, **kwargs)
 
+        self.block_size = block_size
+        self._at_pending = 0
+
         tide_data = bytearray(29)
 
         # load TIDE data from the board
@@ -44,35 +81,78 @@ class PySXB(serial.Serial):
             tide_data = self.read(29)
 
         if tide_data:
-            self.mon_ram = self.decode(tide_data[:3])
+            self.mon_ram = self.decode_at(tide_data, 0)
             self.cpu_type = tide_data[3]
             self.board_id = tide_data[4]
-            self.mon_rom = self.decode(tide_data[8:11])
-            self.shadow_vector_base = self.decode(tide_data[11:14])
-            self.hw_io = self.decode(tide_data[14:17])
-            self.hw_vector_base = self.decode(tide_data[17:20])
+            self.mon_rom = self.decode_at(tide_data, 8)
+            self.shadow_vector_base = self.decode_at(tide_data, 11)
+            self.hw_io = self.decode_at(tide_data, 14)
+            self.hw_vector_base = self.decode_at(tide_data, 17)
 
-            if self.cpu_type:
-                self.emulation = emulation_mode
+            # also resolves the vector addresses for the board and mode
+            self.emulation = emulation_mode
 
-            if not self.cpu_type:
-                self.emulation = True
+    @property
+    def emulation(self):
+        """bool: if the processor is in emulation mode, always true for the 65C02
+
+        Setting it recomputes the vector addresses for the new mode.
+        """
+        return self._emulation
+
+    @emulation.setter
+    def emulation(self, value):
+        # the 65C02 has no native mode
+        self._emulation = bool(value) if self.cpu_type else True
+
+        table = VECTORS_EMULATION if self._emulation else VECTORS_NATIVE
+        (self.coprocessor_vector, self.abort_vector, self.nmi_vector,
+         self.break_vector, self.reset_vector, self.irq_vector) = (
+            self.shadow_vector_base + offset for offset in table)
+
+        # abort and coprocessor vectors only exist on the 65C816
+        if not self.cpu_type:
+            self.abort_vector = None
+            self.coprocessor_vector = None
 
     @staticmethod
     def decode(byte_array):
         """Decode the little endian addressing to int
 
         Args:
-            byte_array (bytearray/int/bytes): the byte array of address or data length
+            byte_array (bytes/bytearray/memoryview/tuple/list): the byte array of address or data length
 
         Returns:
             int: the decoded address or length
         """
-        return_val = 0
-        for i, byte in enumerate(byte_array):
-            return_val |= byte << i * 8
+        if isinstance(byte_array, (tuple, list)):
+            byte_array = bytes(byte_array)
 
-        return return_val
+        return int.from_bytes(byte_array, 'little')
+
+    @staticmethod
+    def decode_at(buffer, offset, address=True):
+        """Decode a little endian address or length in place, without slicing
+
+        Args:
+            buffer (bytes/bytearray/memoryview): the data holding the field
+            offset (int): position of the field within the buffer
+            address (bool): if the field is an address(true) or length(false)
+
+        Returns:
+            int: the decoded address or length, missing bytes count as zero
+        """
+        size = 3 if address else 2
+
+        # short buffer (field at the end or a truncated reply), decode what is there
+        if len(buffer) < offset + size + address:
+            return int.from_bytes(buffer[offset:offset+size], 'little')
+
+        if address:
+            # the fourth byte read belongs to the next field and is masked off
+            return U32.unpack_from(buffer, offset)[0] & 0xFFFFFF
+
+        return U16.unpack_from(buffer, offset)[0]
 
     @staticmethod
     def encode(number, address=True):
@@ -83,157 +163,149 @@ class PySXB(serial.Serial):
             address (bool): if the number is an address(true) or length(false)
 
         Returns:
-            bytearray: the little endian byte array
+            bytes: the little endian byte array
         """
         if address:
-            return (number & 255), ((number >> 8) & 255), ((number >> 16) & 255)
-        
-        return (number & 255), ((number >> 8) & 255)
+            return (number & 0xFFFFFF).to_bytes(3, 'little')
 
-    def hex(self, data, start_address=None):
-        """Used to print the hex output
+        return (number & 0xFFFF).to_bytes(2, 'little')
+
+    @staticmethod
+    def decode_many(byte_array, address=True):
+        """Decode a run of packed little endian addresses or lengths to ints
 
         Args:
-            data (bytearray): contains the data to display
-            start_address (int): starting address for the output
+            byte_array (bytes/bytearray/memoryview): the packed values
+            address (bool): if the values are addresses(true, 3 bytes) or lengths(false, 2 bytes)
 
         Returns:
-            string: formatted output displaying the data
+            list: the decoded addresses or lengths, a trailing partial value is ignored
         """
-        line = ""
-
-        if not start_address:
-            start_address = 0
+        view = memoryview(byte_array).cast('B')
 
-        if isinstance(data, int):
-            data = self.encode(data, False)
-
-        for i, datum in enumerate(data):
+        if not address:
+            count = len(view) // 2
+            return list(struct.unpack(f'<{count}H', view[:count * 2]))
 
-            if i == 0:
-                line = f"{start_address:#06x}:"
-            if i > 0 and i % 16 == 0:
-                line += f"\n{i+start_address:#06x}:"
-            if (i % 8 == 0) and (i % 16 != 0):
-                line += " "
-            line += f" {datum:02X}"
+        return [int.from_bytes(view[i:i+3], 'little') for i in range(0, len(view) - 2, 3)]
 
-        print(line)
+    @staticmethod
+    def encode_many(numbers, address=True):
+        """Encode numbers into packed two or three byte little endian values
 
-    @property
-    def stack(self):
-        """Data contained within the stack region of memory (0x0100 - 0x01FF)
+        Args:
+            numbers (iterable): the addresses or lengths to convert
+            address (bool): if the numbers are addresses(true) or lengths(false)
 
         Returns:
-            bytearray: stack data
+            bytes: the packed little endian values
         """
-        return self.sxb_read(0x0100, 0x0100)
+        numbers = list(numbers)
 
-    @property
-    def processor(self):
-        """Returns the processor status
+        if not address:
+            return struct.pack(f'<{len(numbers)}H', *(number & 0xFFFF for number in numbers))
 
-        Returns:
-            bytearray: processor status data
-        """
-        return self.sxb_read(0x10, self.mon_ram)
+        # each address packs as its low word then its bank byte, like the command headers
+        fields = []
 
-    @property
-    def zero_page(self):
-        """Returns the data contained within the Zero Page (0x0000 - 0x00FF)
+        for number in numbers:
+            fields += (number & 0xFFFF, (number >> 16) & 0xFF)
 
-        Returns:
-            bytearray:  "zero page" (0x0000 - 0x00FF) data
-        """
-        return self.sxb_read(0x0100, 0x0000)
+        return struct.pack('<' + 'HB' * len(numbers), *fields)
 
-    @property
-    def irq_vector(self):
-        """Returns the address of the interrupt vector
+    def hex(self, data, start_address=None):
+        """Formats data as a hex dump, 16 bytes per line
+
+        Args:
+            data (bytes/bytearray/int): contains the data to display
+            start_address (int): starting address for the output
 
         Returns:
-            int: address of the IRQ vector
+            string: formatted output displaying the data
         """
-        address = self.shadow_vector_base + 10
+        lines = []
 
-        if self.emulation:
-            return address + 16
+        if not start_address:
+            start_address = 0
 
-        return address
+        buffer = self.encode(data, False) if isinstance(data, int) else bytes(data)
+        length = len(buffer)
+        byte_format = "{:02X}".format
 
-    @property
-    def reset_vector(self):
-        """Returns the address of the reset vector
+        for offset in range(0, length, 16):
+            line = f"{start_address+offset:#06x}: " + " ".join(map(byte_format, buffer[offset:offset+8]))
 
-        Returns:
-            int: address of the reset vector
-        """
-        address = self.shadow_vector_base + 8
+            if length > offset + 8:
+                line += "  " + " ".join(map(byte_format, buffer[offset+8:offset+16]))
 
-        if self.emulation:
-            return address + 16
+            lines.append(line)
 
-        return address
+        return "\n".join(lines)
 
-    @property
-    def nmi_vector(self):
-        """Returns the address of the non-maskable interrupt vector
+    def read_stack(self):
+        """Reads the data contained within the stack region of memory (0x0100 - 0x01FF)
 
         Returns:
-            int: address of the NMI vector
+            bytes: stack data
         """
-        address = self.shadow_vector_base + 6
-
-        if self.emulation:
-            return address + 16
+        return self.sxb_read(0x0100, 0x0100)
 
-    @property
-    def break_vector(self):
-        """Returns the address of the break interrupt vector
+    def read_processor(self):
+        """Reads the processor status
 
         Returns:
-            int: address of the break IRQ vector
+            bytes: processor status data
         """
-        address = self.shadow_vector_base + 2
+        return self.sxb_read(0x10, self.mon_ram)
 
-        if self.emulation:
-            return address + 24
+    def read_zero_page(self):
+        """Reads the data contained within the Zero Page (0x0000 - 0x00FF)
 
-        return address
+        Returns:
+            bytes:  "zero page" (0x0000 - 0x00FF) data
+        """
+        return self.sxb_read(0x0100, 0x0000)
 
-    @property
-    def abort_vector(self):
-        """Returns the address of the abort vector
+    def read_snapshot(self):
+        """Reads the stack, processor status and zero page in a single round trip
+
+        All three READ commands are sent in one write and the replies are
+        collected with one read, rather than waiting out each handshake and
+        response in turn.
 
         Returns:
-            int: address of the abort vector
+            tuple: stack, processor status and zero page data, or None if a
+                handshake was not answered OK
         """
-        address = self.shadow_vector_base + 4
+        regions = ((0x0100, 0x0100), (self.mon_ram, 0x10), (0x0000, 0x0100))
 
-        if not self.cpu_type:
+        # keep owed handshake replies out of the data
+        if not self.sxb_ack():
             return None
 
-        if self.emulation:
-            return address + 16
+        self.write(b''.join(AT + self._pack_header(READ, address, length) for address, length in regions))
 
-        return address
+        # each region arrives as an OK byte followed by its data
+        size = sum(length + 1 for _, length in regions)
+        reply = self.read(size)
+        snapshot = []
+        offset = 0
 
-    @property
-    def coprocessor_vector(self):
-        """Returns the address of the coprocessor vector
-
-        Returns:
-            int: address of the coprocessor vector
-        """
-        address = self.shadow_vector_base
-
-        if not self.cpu_type:
+        # on a timeout or bad handshake the rest of the replies may still be
+        # arriving, drop them so the next command starts in step
+        if len(reply) != size:
+            self._resync()
             return None
 
-        if self.emulation:
-            return address + 16
+        for _, length in regions:
+            if reply[offset:offset+1] != bytes((OK,)):
+                self._resync()
+                return None
+
+            snapshot.append(reply[offset+1:offset+1+length])
+            offset += length + 1
 
-        return address
+        return tuple(snapshot)
 
     def hardware_address(self, address):
         """Returns the base address of the ports for the SXB
@@ -251,38 +323,88 @@ class PySXB(serial.Serial):
         """
         try:
             if self.write(AT):
-                return ord(self.read(1)) == OK
+                # collect any handshakes still owed by pipelined commands as well
+                count, self._at_pending = self._at_pending + 1, 0
+                return self.read(count) == bytes((OK,)) * count
         except serial.SerialTimeoutException:
             return False
 
-    def sxb_command(self, cmd_code, *, address=None, length=None):
+    def sxb_ack(self):
+        """Reads the handshake replies owed by commands sent with wait=False
+
+        Returns:
+            bool: returns true if every pending handshake was answered OK, else false
+        """
+        if not self._at_pending:
+            return True
+
+        count, self._at_pending = self._at_pending, 0
+        return self.read(count) == bytes((OK,)) * count
+
+    @staticmethod
+    def _pack_header(cmd_code, address=None, length=None):
+        """Packs a command code with its optional address and length
+
+        Returns:
+            bytes: the command header
+        """
+        if address is None:
+            if length is None:
+                return CMD.pack(cmd_code)
+
+            return CMD_LEN.pack(cmd_code, length)
+
+        # the 24-bit address goes out as its low word then its bank byte
+        low, bank = address & 0xFFFF, (address >> 16) & 0xFF
+
+        if length is None:
+            return CMD_ADDR.pack(cmd_code, low, bank)
+
+        return CMD_ADDR_LEN.pack(cmd_code, low, bank, length)
+
+    def _resync(self):
+        """Drops owed handshake replies after a pipelined command failed part way
+
+        The AT may or may not have reached the board, so whether an OK is owed
+        is unknown; flushing the input and the count keeps later reads framed.
+        """
+        self.reset_input_buffer()
+        self._at_pending = 0
+
+    def sxb_command(self, cmd_code, *, address=None, length=None, payload=b'', wait=True):
         """submits a command to the board
 
         Args:
             cmd_code (int): the command code to issue
             address (int): address to begin the command if applicable
             length (int): the byte count for the command
+            payload (bytes/bytearray/memoryview): data sent in the same write as the command header
+            wait (bool): wait for the AT handshake before sending (default), when false the
+                AT is sent with the command and its reply is left for sxb_ack or the next sxb_at
 
         Returns:
             (bool): returns true if more than one byte was successfully written, else false
         """
 
-        if self.sxb_at():
-            command = bytearray((cmd_code,))
-    
-            if address:
-                for element in self.encode(address):
-                    command.append(element)
-    
-            if length:
-                for element in self.encode(length, False):
-                    command.append(element)
-    
+        if not wait or self.sxb_at():
+            header = self._pack_header(cmd_code, address, length)
+
+            # a single allocation for the AT (when pipelined), header and payload
+            command = b''.join((b'' if wait else AT, header, payload))
+
             try:
                 write_count = self.write(command)
+
+                if not wait and write_count:
+                    self._at_pending += 1
+
                 return write_count > 0
             except serial.SerialTimeoutException as error:
                 print(f"Error: {error}\n")
+
+                if not wait:
+                    self._resync()
+
                 return None
             except TypeError as error:
                 print(f"Error: {error}\n")
@@ -292,30 +414,36 @@ class PySXB(serial.Serial):
         """writes the data to the board
 
         Args:
-            data (tuple/list): the data to be written
+            data (bytes/bytearray/memoryview/tuple/list): the data to be written
             address (int): the starting address
 
         Returns:
             int: bytes written to port
         """
+        # tuples and lists are copied into bytes once, up front
+        if not isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data)
 
-        if not address:
+        if address is None:
             return self.write(data)
 
-        length = len(data)
+        # blocks are memoryview slices, which saves sxb_write a copy per block,
+        # but pyserial's write() still copies each one with tobytes().  Every
+        # view is released on the way out, even when the port raises, so a
+        # memory mapped caller (sxb_load) can close its map afterwards
+        with memoryview(data).cast('B') as view:
+            length = len(view)
 
-        if self.sxb_command(WRITE, address=address, length=length):
-            if length < BLK_SIZE:
-                return self.write(data)
+            # the first block rides along with the command header in one write
+            with view[:self.block_size] as first:
+                if not self.sxb_command(WRITE, address=address, length=length, payload=first):
+                    return 0
 
-            for blk in range(0, length, BLK_SIZE):
-                if blk + BLK_SIZE < length:
-                    self.write(data[blk:blk+BLK_SIZE])
-                    continue
+            for blk in range(self.block_size, length, self.block_size):
+                with view[blk:blk+self.block_size] as block:
+                    self.write(block)
 
-                self.write(data[blk:length])
-
-        return 0
+            return length
 
     def sxb_execute(self, address, a_reg=0, x_reg=0, y_reg=0, processor_flags=0x76):
         """ execute the program at the starting address, with the A/X/Y/Processor flags set
@@ -331,53 +459,52 @@ class PySXB(serial.Serial):
         Returns:
             bool: true if submission was successful or false if not
         """
-        a_reg = self.encode(a_reg, False)
-        x_reg = self.encode(x_reg, False)
-        y_reg = self.encode(y_reg, False)
-
-        address = self.encode(address)
-        processor_state = (
-            a_reg,                      # A Register
-            x_reg,                      # X register
-            y_reg,                      # Y register
-            address[0], address[1],     # Program Counter
-            0, 0,                       # Direct Register
-            255, 1,                     # Stack Pointer
+        processor_state = PROCESSOR_STATE.pack(
+            a_reg & 0xFFFF,             # A Register
+            x_reg & 0xFFFF,             # X register
+            y_reg & 0xFFFF,             # Y register
+            address & 0xFFFF,           # Program Counter
+            0x0000,                     # Direct Register
+            0x01FF,                     # Stack Pointer
             processor_flags,            # Processor status flags
-            int(self.emulation),             # Emulation Off/On
+            int(self.emulation),        # Emulation Off/On
             0,                          # Program Bank Register
             0                           # Data Bank Register
         )
 
-        self.sxb_write(processor_state, self.mon_ram)
-        return self.sxb_command(EXEC, length=1)
+        # send both commands without stopping for each handshake, then check
+        # the two replies together
+        if not self.sxb_command(WRITE, address=self.mon_ram, length=PROCESSOR_STATE.size,
+                                payload=processor_state, wait=False):
+            return False
+
+        if not self.sxb_command(EXEC, length=1, wait=False):
+            return False
+
+        return self.sxb_ack()
 
     def sxb_read(self, length: int, address=None):
         """reads length bytes of memory starting from address (if given)
 
+        Without an address no READ command is sent and whatever the board
+        has already queued on the port is returned.
+
         Args:
             length (int):  length of memory to read
             address (int): the address to read the memory
 
         Returns:
-            bytes/bytearray: bytes of data read
+            bytes: bytes of data read
         """
-        if address:
+        if address is not None:
             self.sxb_command(READ, address=address, length=length)
+        else:
+            # keep owed handshake replies out of the data
+            self.sxb_ack()
 
-        if length < BLK_SIZE:
-            return_data = self.read(length)
-            return return_data
-
-        return_data = bytearray(length)
-
-        for blk in range(0, length, BLK_SIZE):
-            if blk + BLK_SIZE < length:
-                return_data[blk: blk + BLK_SIZE] = self.read(BLK_SIZE)
-                continue
-            return_data[blk:length] = self.read(length-blk)
-
-        return return_data
+        # one read for the whole region, pyserial blocks until length bytes
+        # arrive (or the timeout expires) so there is no need to pace blocks
+        return self.read(length)
 
     def sxb_load(self, file_path):
         """Load rom image
@@ -392,15 +519,20 @@ class PySXB(serial.Serial):
             ValueError: if the rom does not have 0x5A at the begging signifying
                 rom was not compiled/assembled with the -g flag
         """
-        with open(file_path, 'rb') as fh:
-            rom_data = fh.read()
+        # map the image rather than reading it, only the pages sent are touched
+        with open(file_path, 'rb') as fh, \
+                mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as rom_map, \
+                memoryview(rom_map) as rom_data:
+
+            if rom_data[0] == 0x5a:     # checking for SXB flag symbol from the WDC assembler/Compiler
+
+                code_address = self.decode_at(rom_data, 1)
+                code_length = self.decode_at(rom_data, 4, False)
 
-        if rom_data[0] == 0x5a:     # checking for SXB flag symbol from the WDC assembler/Compiler
+                # views must be released before the map closes
+                with rom_data[7:7+code_length] as code:
+                    self.sxb_write(code, code_address)
 
-            code_address = self.decode(rom_data[1:4])
-            code_length = self.decode(rom_data[4:6])
-            code = rom_data[7:7+code_length]
-            self.sxb_write(code, code_address)
-            return code_address, code_length
+                return code_address, code_length
 
         raise ValueError("Program needs to be compiled/assembled with the -g option")
@@ -0,0 +1,277 @@
+import struct
+
+import pytest
+import serial
+
+from PySXB.pysxb import AT, EXEC, OK, READ, WRITE, PySXB
+
+MON_RAM = 0x7E00
+SHADOW_VECTORS = 0x7EE0
+
+# OK for the AT, then the 29 byte TIDE block of a 65C816 board
+TIDE_REPLY = bytes((OK,)) + struct.pack(
+    '<3sBB3x3s3s3s3s9x',
+    MON_RAM.to_bytes(3, 'little'), 1, 0x21, (0x8000).to_bytes(3, 'little'),
+    SHADOW_VECTORS.to_bytes(3, 'little'), (0x7F00).to_bytes(3, 'little'), (0xFFE0).to_bytes(3, 'little'))
+
+
+class FakeSXB(PySXB):
+    """PySXB on an unopened port, with write() and read() served from memory"""
+
+    def __init__(self, rx=TIDE_REPLY, **kwargs):
+        self.tx = bytearray()
+        self.rx = bytearray(rx)
+        super().__init__(None, **kwargs)
+        self.tx.clear()
+
+    def write(self, data):
+        self.tx += data
+        return len(data)
+
+    def read(self, size=1):
+        data = bytes(self.rx[:size])
+        del self.rx[:size]
+        return data
+
+    def reset_input_buffer(self):
+        self.rx.clear()
+
+
+def test_init_decodes_tide_block():
+    sxb = FakeSXB()
+
+    assert sxb.mon_ram == MON_RAM
+    assert sxb.cpu_type == 1
+    assert sxb.shadow_vector_base == SHADOW_VECTORS
+    assert sxb.hw_vector_base == 0xFFE0
+
+
+def test_sxb_at_reads_one_ok():
+    sxb = FakeSXB()
+    sxb.rx += bytes((OK, 0x42))
+
+    assert sxb.sxb_at()
+    assert sxb.tx == AT
+    assert sxb.rx == bytes((0x42,))
+
+
+def test_sxb_at_rejects_other_replies():
+    sxb = FakeSXB()
+    sxb.rx += bytes((0x00,))
+
+    assert not sxb.sxb_at()
+
+
+def test_sxb_at_collects_pending_handshakes():
+    sxb = FakeSXB()
+    sxb.sxb_command(EXEC, length=1, wait=False)
+    sxb.rx += bytes((OK, OK, 0x42))
+
+    assert sxb.sxb_at()
+    assert sxb.rx == bytes((0x42,))
+    assert sxb.sxb_ack()
+
+
+def test_sxb_ack_without_pending_reads_nothing():
+    sxb = FakeSXB()
+    sxb.rx += bytes((0x42,))
+
+    assert sxb.sxb_ack()
+    assert sxb.rx == bytes((0x42,))
+
+
+def test_sxb_ack_reads_every_pending_handshake():
+    sxb = FakeSXB()
+    sxb.sxb_command(EXEC, length=1, wait=False)
+    sxb.sxb_command(EXEC, length=1, wait=False)
+    sxb.rx += bytes((OK, 0x00))
+
+    assert not sxb.sxb_ack()
+    assert not sxb.rx
+
+
+def test_sxb_execute_pipelines_both_commands():
+    sxb = FakeSXB()
+    sxb.rx += bytes((OK, OK))
+
+    assert sxb.sxb_execute(0x2000, a_reg=0x10)
+
+    state = bytes((0x10, 0, 0, 0, 0, 0, 0x00, 0x20, 0, 0, 0xFF, 0x01, 0x76, 1, 0, 0))
+    assert sxb.tx == (AT + bytes((WRITE, 0x00, 0x7E, 0x00, 0x10, 0x00)) + state
+                      + AT + bytes((EXEC, 0x01, 0x00)))
+    assert not sxb.rx
+
+
+def test_sxb_execute_stops_when_write_fails():
+    sxb = FakeSXB()
+    sxb.rx += bytes((OK,))
+
+    attempts = []
+
+    def write(data):
+        attempts.append(bytes(data))
+        raise serial.SerialTimeoutException('write timeout')
+
+    sxb.write = write
+
+    assert not sxb.sxb_execute(0x2000)
+    assert len(attempts) == 1                   # EXEC was never sent
+    assert not sxb.rx
+    assert sxb.sxb_ack()
+
+
+def test_sxb_load_raises_port_errors_unchanged(tmp_path):
+    rom = tmp_path / 'rom.bin'
+    rom.write_bytes(bytes((0x5a, 0x00, 0x20, 0x00, 0x80, 0x00, 0x00)) + bytes(0x80))
+
+    sxb = FakeSXB()
+    sxb.rx += bytes((OK,))
+
+    def write(data):
+        if bytes(data) != AT:
+            raise serial.SerialException('port went away')
+        return len(data)
+
+    sxb.write = write
+
+    with pytest.raises(serial.SerialException, match='port went away'):
+        sxb.sxb_load(rom)
+
+
+def test_read_snapshot_splits_replies():
+    sxb = FakeSXB()
+    sxb.rx += (bytes((OK,)) + b'S' * 0x100 + bytes((OK,)) + b'P' * 0x10
+               + bytes((OK,)) + b'Z' * 0x100)
+
+    assert sxb.read_snapshot() == (b'S' * 0x100, b'P' * 0x10, b'Z' * 0x100)
+    assert sxb.tx == (AT + bytes((READ, 0x00, 0x01, 0x00, 0x00, 0x01))
+                      + AT + bytes((READ, 0x00, 0x7E, 0x00, 0x10, 0x00))
+                      + AT + bytes((READ, 0x00, 0x00, 0x00, 0x00, 0x01)))
+
+
+def test_read_snapshot_rejects_a_missing_ok():
+    sxb = FakeSXB()
+    sxb.rx += (bytes((OK,)) + b'S' * 0x100 + bytes((0x00,)) + b'P' * 0x10
+               + bytes((OK,)) + b'Z' * 0x100 + b'late')
+
+    assert sxb.read_snapshot() is None
+    assert not sxb.rx
+
+
+def test_read_snapshot_rejects_a_short_reply():
+    sxb = FakeSXB()
+    sxb.rx += bytes((OK,)) + b'S' * 0x100 + bytes((OK,)) + b'P' * 0x10
+
+    assert sxb.read_snapshot() is None
+    assert not sxb.rx
+
+
+def test_read_snapshot_stops_on_a_failed_owed_handshake():
+    sxb = FakeSXB()
+    sxb.sxb_command(EXEC, length=1, wait=False)
+    sxb.tx.clear()
+    sxb.rx += bytes((0x00,))
+
+    assert sxb.read_snapshot() is None
+    assert not sxb.tx
+
+
+def test_decode_at_reads_fields_in_place():
+    data = bytes((0x5A, 0x00, 0x20, 0x01, 0x34, 0x12))
+
+    assert PySXB.decode_at(data, 1) == 0x012000
+    assert PySXB.decode_at(data, 4, False) == 0x1234
+
+
+def test_decode_at_handles_fields_at_the_end():
+    assert PySXB.decode_at(b'\x00\x20\x00', 0) == 0x2000
+    assert PySXB.decode_at(b'\x00\x20', 0) == 0x2000
+    assert PySXB.decode_at(b'\x34\x12', 0, False) == 0x1234
+    assert PySXB.decode_at(b'', 0) == 0
+
+
+def test_init_survives_a_short_tide_reply():
+    sxb = FakeSXB(TIDE_REPLY[:18])        # OK and the first 17 bytes
+
+    assert sxb.mon_ram == MON_RAM
+    assert sxb.shadow_vector_base == SHADOW_VECTORS
+    assert sxb.hw_vector_base == 0
+
+
+def test_vectors_follow_emulation_mode():
+    sxb = FakeSXB()
+
+    assert sxb.emulation
+    assert sxb.irq_vector == SHADOW_VECTORS + 0x1A
+    assert sxb.break_vector == SHADOW_VECTORS + 0x1A
+
+    sxb.emulation = False
+
+    assert sxb.irq_vector == SHADOW_VECTORS + 0x0A
+    assert sxb.break_vector == SHADOW_VECTORS + 0x02
+    assert sxb.nmi_vector == SHADOW_VECTORS + 0x06
+    assert sxb.coprocessor_vector == SHADOW_VECTORS
+
+
+def test_65c02_stays_in_emulation_mode():
+    sxb = FakeSXB(TIDE_REPLY[:4] + bytes((0,)) + TIDE_REPLY[5:])
+
+    sxb.emulation = False
+
+    assert sxb.emulation
+    assert sxb.irq_vector == SHADOW_VECTORS + 0x1A
+    assert sxb.abort_vector is None
+    assert sxb.coprocessor_vector is None
+
+
+def test_hex_returns_the_dump():
+    dump = FakeSXB().hex(bytes(range(20)), 0x0100)
+
+    assert dump == ('0x0100: 00 01 02 03 04 05 06 07  08 09 0A 0B 0C 0D 0E 0F\n'
+                    '0x0110: 10 11 12 13')
+
+
+@pytest.mark.parametrize('block_size', [0, -1])
+def test_block_size_must_be_positive(block_size):
+    with pytest.raises(ValueError, match='block_size'):
+        FakeSXB(block_size=block_size)
+
+
+def test_sxb_write_splits_into_blocks():
+    sxb = FakeSXB(block_size=4)
+    sxb.rx += bytes((OK,))
+
+    assert sxb.sxb_write(bytes(range(10)), 0x2000) == 10
+    assert sxb.tx == (AT + bytes((WRITE, 0x00, 0x20, 0x00, 0x0A, 0x00, 0, 1, 2, 3))
+                      + bytes((4, 5, 6, 7, 8, 9)))
+
+
+def test_decode_accepts_tuples_and_bytes():
+    assert PySXB.decode((0x56, 0x34, 0x12)) == PySXB.decode(b'\x56\x34\x12') == 0x123456
+    assert PySXB.decode([0x34, 0x12]) == PySXB.decode(bytearray(b'\x34\x12')) == 0x1234
+
+
+def test_decode_rejects_ints():
+    with pytest.raises(TypeError):
+        PySXB.decode(0x1234)
+
+
+def test_decode_many_matches_decode():
+    addresses = bytes(range(8))
+    assert PySXB.decode_many(addresses) == [PySXB.decode(addresses[:3]), PySXB.decode(addresses[3:6])]
+    assert PySXB.decode_many(addresses) == [0x020100, 0x050403]
+
+    lengths = bytes(range(5))
+    assert PySXB.decode_many(lengths, False) == [PySXB.decode(lengths[:2]), PySXB.decode(lengths[2:4])]
+    assert PySXB.decode_many(lengths, False) == [0x0100, 0x0302]
+
+
+def test_encode_many_matches_encode():
+    addresses = [0x000000, 0x123456, 0xFFFFFF, 0x1000000]
+    assert PySXB.encode_many(addresses) == b''.join(PySXB.encode(address) for address in addresses)
+
+    lengths = [0x0000, 0x1234, 0xFFFF, 0x10000]
+    assert PySXB.encode_many(lengths, False) == b''.join(PySXB.encode(length, False) for length in lengths)
+
+    assert PySXB.encode_many([]) == b''
+    assert PySXB.decode_many(PySXB.encode_many(addresses)) == [0x000000, 0x123456, 0xFFFFFF, 0x000000]